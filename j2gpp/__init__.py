@@ -1,3 +1,4 @@
+# PYTHON_ARGCOMPLETE_OK
 # ╔═══════════════════════════════════════════════════════════════════════════╗
 # ║ Project:     j2gpp - Jinja2-based General Purpose Preprocessor            ║
 # ║ Author:      Louis Duret-Robert - louisduret@gmail.com                    ║
@@ -0,0 +1,17 @@
+# PYTHON_ARGCOMPLETE_OK
+# ╔═══════════════════════════════════════════════════════════════════════════╗
+# ║ Project:     j2gpp - Jinja2-based General Purpose Preprocessor            ║
+# ║ Author:      Louis Duret-Robert - louisduret@gmail.com                    ║
+# ║ Website:     louis-dr.github.io                                           ║
+# ║ License:     MIT License                                                  ║
+# ║ File:        __main__.py                                                  ║
+# ╟───────────────────────────────────────────────────────────────────────────╢
+# ║ Description: Entry point for running the package with python -m j2gpp.    ║
+# ║                                                                           ║
+# ╚═══════════════════════════════════════════════════════════════════════════╝
+
+
+
+from j2gpp.j2gpp import main
+
+main()
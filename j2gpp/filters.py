@@ -28,8 +28,12 @@ from j2gpp.utils import *
 # If using fork of Jinja2, then import the render_time_only decorator
 try: from jinja2.utils import render_time_only
 except ImportError:
+  try: from jinja2 import pass_context
+  except ImportError: from jinja2 import contextfunction as pass_context
   def render_time_only(func):
-    def decorated(*args, **kwargs):
+    # Filters using the context cannot be evaluated at compile time with constant arguments
+    @pass_context
+    def decorated(context, *args, **kwargs):
       throw_warning("The installed Jinja2 library doesn't support the @render_time_only decorator. The function {func.__name__} may get executed regarless of conditional block.")
       return func(*args, **kwargs)
     return decorated
@@ -395,6 +399,19 @@ extra_filters['combinations_with_replacement_range'] = lambda L,start,stop : ite
 # Flag to skip rendering source template according to export filter option
 write_source_toggle = [True]
 
+# Directories already created for exported blocks
+export_dirpaths = set()
+
+# Create directories for an export path once, blocks are often exported in loops
+def make_export_directory(dirpath):
+  if dirpath in export_dirpaths:
+    return
+  try:
+    os.makedirs(dirpath, exist_ok=True)
+    export_dirpaths.add(dirpath)
+  except OSError as exc:
+      throw_error(f"Cannot create directory '{dirpath}' to export block.")
+
 # Write content of the block to a file
 @render_time_only
 def write(content, path, preserve=False, write_source=True):
@@ -403,20 +420,15 @@ def write(content, path, preserve=False, write_source=True):
   write_source_toggle[0] = write_source_toggle[0] and write_source
 
   # Get full path
-  path = os.path.expandvars(os.path.expanduser(os.path.abspath(path)))
+  path = get_full_path(path)
   print(f"Exporting block content to {path}")
 
   # Create directories for output path
-  dirpath = os.path.dirname(path)
-  try:
-    os.makedirs(dirpath, exist_ok=True)
-  except OSError as exc:
-      throw_error(f"Cannot create directory '{dirpath}' to export block.")
+  make_export_directory(os.path.dirname(path))
 
   # Write to file
   try:
-    with open(path,'w') as file:
-      file.write(content)
+    write_file_atomic(path, content)
   except OSError as exc:
     # Catch file write exceptions
     if exc.errno == errno.EISDIR:
@@ -443,15 +455,11 @@ def append(content, path, preserve=False, write_source=True):
   write_source_toggle[0] = write_source_toggle[0] and write_source
 
   # Get full path
-  path = os.path.expandvars(os.path.expanduser(os.path.abspath(path)))
+  path = get_full_path(path)
   print(f"Exporting block content to {path}")
 
   # Create directories for output path
-  dirpath = os.path.dirname(path)
-  try:
-    os.makedirs(dirpath, exist_ok=True)
-  except OSError as exc:
-      throw_error(f"Cannot create directory '{dirpath}' to export block.")
+  make_export_directory(os.path.dirname(path))
 
   # Append to file
   try:
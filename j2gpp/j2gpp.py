@@ -13,30 +13,52 @@
 
 
 
-import argparse
-import glob
-import imp
+import importlib
 import os
 import re
 import errno
-import shutil
-from datetime import datetime
-from platform import python_version
-from jinja2 import Environment, FileSystemLoader, StrictUndefined
-from jinja2 import __version__ as jinja2_version
-import jinja2.exceptions as jinja2_exceptions
+import stat
+import sys
+import time
+from collections import ChainMap
+from types import MappingProxyType
 from j2gpp.utils import *
-from j2gpp.filters import extra_filters, write_source_toggle
-from j2gpp.tests import extra_tests
+
+# Render function of the main process called by the forked worker processes
+render_worker_function = None
+
+# Render a template in a worker process and return its output log, errors and warnings
+def render_worker(src_dict):
+  import io
+  from contextlib import redirect_stdout
+  del errors[:]
+  del warnings[:]
+  # The log is printed by the main process such that the workers do not interleave their lines
+  with redirect_stdout(io.StringIO()) as log:
+    render_worker_function(src_dict)
+  return log.getvalue(), errors.copy(), warnings.copy()
 
 def main():
 
   j2gpp_version = "2.2.1"
 
+  # Version and license arguments answered before building the arguments parser
+  cli_args = sys.argv[1:]
+  if '--' in cli_args:
+    cli_args = cli_args[:cli_args.index('--')]
+  if '--version' in cli_args:
+    print(j2gpp_version)
+    exit()
+  if '--license' in cli_args:
+    print_license()
+    exit()
+
   # Source templates
   sources = []
   # Non-template files to copy
   to_copy= []
+  # Pairs of source and output paths already fetched
+  fetched_paths = set()
   # Global variables
   global_vars = {}
   # Special options
@@ -50,80 +72,108 @@ def main():
   # │ Variable files loaders │
   # └────────────────────────┘
 
+  # Parser libraries imported once on first use
+  loader_modules = {}
+
+  def import_loader_module(module_name, var_format=None):
+    if module_name not in loader_modules:
+      try:
+        loader_modules[module_name] = importlib.import_module(module_name)
+      except ImportError:
+        loader_modules[module_name] = None
+    # Optional libraries have no format
+    if not loader_modules[module_name] and var_format:
+      throw_error(f"Could not import Python library '{module_name}' to parse {var_format} variables files.")
+    return loader_modules[module_name]
+
+  # YAML parser shared by all the YAML variables files
+  yaml_parser = []
+
   def load_yaml(var_path):
     var_dict = {}
-    try:
-      from ruamel.yaml import YAML
-      yaml = YAML(typ="safe")
-      with open(var_path) as var_file:
+    ruamel_yaml = import_loader_module('ruamel.yaml', 'YAML')
+    if ruamel_yaml:
+      if not yaml_parser:
+        # Uses the C-based parser from 'ruamel.yaml.clib' when it is installed
+        yaml_parser.append(ruamel_yaml.YAML(typ="safe", pure=False))
+      with open(var_path, 'rb') as var_file:
         try:
-          var_dict = yaml.load(var_file)
+          var_dict = yaml_parser[0].load(var_file)
         except Exception as exc:
           throw_error(f"Exception occurred while loading '{var_path}' : \n  {type(exc).__name__}\n{intend_text(exc)}")
-    except ImportError:
-      throw_error("Could not import Python library 'ruamel.yaml' to parse YAML variables files.")
     return var_dict
 
   def load_json(var_path):
     var_dict = {}
-    try:
-      import json
-      with open(var_path) as var_file:
+    json = import_loader_module('json', 'JSON')
+    # Faster parser used when installed
+    orjson = import_loader_module('orjson')
+    if json:
+      with open(var_path, 'rb') as var_file:
         try:
-          var_dict = json.load(var_file)
+          if orjson:
+            # Only parses bytes and not file objects
+            var_content = var_file.read()
+            # Integers wider than 64 bits are parsed as floats by the faster parser, losing precision
+            if re.search(rb'\d{19}', var_content):
+              var_dict = json.loads(var_content)
+            else:
+              try:
+                var_dict = orjson.loads(var_content)
+              except orjson.JSONDecodeError:
+                # Standard parser also supports NaN and infinity
+                var_dict = json.loads(var_content)
+          else:
+            var_dict = json.load(var_file)
         except Exception as exc:
           throw_error(f"Exception occurred while loading '{var_path}' : \n  {type(exc).__name__}\n{intend_text(exc)}")
-    except ImportError:
-      throw_error("Could not import Python library 'json' to parse JSON variables files.")
     return var_dict
 
+  # Postprocessor to auto cast the values
+  def xml_postprocessor(path, key, value):
+    # Convert attribute to child
+    if options['xml_convert_attributes']:
+      key = key.lstrip("@")
+    # Remove namespace
+    if options['xml_remove_namespaces']:
+      key = key.split(":")[-1]
+    # Prepare bool for auto-cast
+    if value == "true":  value = "True"
+    if value == "false": value = "False"
+    # Auto-cast value
+    value = auto_cast_str(value)
+    return key, value
+
   def load_xml(var_path):
     var_dict = {}
-    try:
-      import xmltodict
-      # Postprocessor to auto cast the values
-      def xml_postprocessor(path, key, value):
-        # Convert attribute to child
-        if options['xml_convert_attributes']:
-          key = key.lstrip("@")
-        # Remove namespace
-        if options['xml_remove_namespaces']:
-          key = key.split(":")[-1]
-        # Prepare bool for auto-cast
-        if value == "true":  value = "True"
-        if value == "false": value = "False"
-        # Auto-cast value
-        value = auto_cast_str(value)
-        return key, value
-      with open(var_path) as var_file:
+    xmltodict = import_loader_module('xmltodict', 'XML')
+    if xmltodict:
+      with open(var_path, 'rb') as var_file:
         try:
-          var_dict = xmltodict.parse(var_file.read(), postprocessor=xml_postprocessor)
+          # Stream the file to the expat parser instead of reading it whole
+          var_dict = xmltodict.parse(var_file, postprocessor=xml_postprocessor)
           # If root element is '_', then remove this level
           if '_' in var_dict.keys():
             var_dict = var_dict['_']
         except Exception as exc:
           throw_error(f"Exception occurred while loading '{var_path}' : \n  {type(exc).__name__}\n{intend_text(exc)}")
-    except ImportError:
-      throw_error("Could not import Python library 'xmltodict' to parse XML variables files.")
     return var_dict
 
   def load_toml(var_path):
     var_dict = {}
-    try:
-      import toml
+    toml = import_loader_module('toml', 'TOML')
+    if toml:
       with open(var_path) as var_file:
         try:
           var_dict = toml.load(var_file)
         except Exception as exc:
           throw_error(f"Exception occurred while loading '{var_path}' : \n  {type(exc).__name__}\n{intend_text(exc)}")
-    except ImportError:
-      throw_error("Could not import Python library 'toml' to parse TOML variables files.")
     return var_dict
 
   def load_ini(var_path):
     var_dict = {}
-    try:
-      import configparser
+    configparser = import_loader_module('configparser', 'INI/CFG')
+    if configparser:
       with open(var_path) as var_file:
         try:
           config = configparser.ConfigParser()
@@ -136,57 +186,63 @@ def main():
               var_dict[section] = dict(config.items(section))
         except Exception as exc:
           throw_error(f"Exception occurred while loading '{var_path}' : \n  {type(exc).__name__}\n{intend_text(exc)}")
-    except ImportError:
-      throw_error("Could not import Python library 'configparser' to parse INI/CFG variables files.")
     return var_dict
 
   def load_env(var_path):
     var_dict = {}
-    with open(var_path) as var_file:
-      for line_nbr, line in enumerate(var_file):
-        if line and line != "\n":
-          # Comment line
-          if line[0] == '#':
-            continue
-          # Syntax is var=value
-          if '=' not in line:
-            throw_error(f"Incorrect ENV file syntax '{line}' line {line_nbr} of file '{var_path}'.")
-            continue
-          var, val = line.split('=')
-          var = var.strip()
-          val = val.strip()
-          val = auto_cast_str(val)
-          # Handle conflits inside the file
-          if var in var_dict:
-            throw_warning(f"Variable '{var}' redefined from '{var_dict[var]}' to '{val}' in file '{var_path}'.")
-          var_dict[var] = val
+    with open(var_path, 'rb') as var_file:
+      var_lines = var_file.read().splitlines()
+    for line_nbr, line in enumerate(var_lines, 1):
+      # Empty and comment lines are skipped before decoding
+      if not line.strip() or line[:1] == b'#':
+        continue
+      line = line.decode()
+      # Syntax is var=value, the value can contain '='
+      var, sep, val = line.partition('=')
+      if not sep:
+        throw_error(f"Incorrect ENV file syntax '{line}' line {line_nbr} of file '{var_path}'.")
+        continue
+      var = sys.intern(var.strip())
+      val = auto_cast_str(val.strip())
+      # Handle conflits inside the file
+      if var in var_dict:
+        throw_warning(f"Variable '{var}' redefined from '{var_dict[var]}' to '{val}' in file '{var_path}'.")
+      var_dict[var] = val
     return var_dict
 
   def load_csv(var_path, delimiter=''):
     var_dict = {}
     if not delimiter: delimiter = options['csv_delimiter']
-    try:
-      import csv
+    csv = import_loader_module('csv', 'CSV/TSV')
+    if csv:
       with open(var_path) as var_file:
         try:
-          csv_reader = csv.DictReader(var_file, delimiter=delimiter, escapechar=options['csv_escape_char'])
-          # First columns for keys
-          main_key = csv_reader.fieldnames[0]
+          csv_reader = csv.reader(var_file, delimiter=delimiter, escapechar=options['csv_escape_char'])
+          fieldnames = next(csv_reader, [])
+          # Strip whitespace around keys and values
+          strip_cell = (lambda cell: cell) if options['csv_dont_strip'] else str.strip
+          # First column for keys, other column names for the row fields
+          row_keys = [sys.intern(strip_cell(key)) for key in fieldnames[1:]]
           for row in csv_reader:
-            var = row.pop(main_key)
-            # Strip whitespace around key and value
-            if not options['csv_dont_strip']:
-              row = {key.strip():val.strip() for key,val in row.items()}
-            # Auto cast values
-            row = {key:auto_cast_str(val) for key,val in row.items()}
+            # Skip empty lines
+            if not row:
+              continue
+            # Cells without a column name cannot be stored
+            if len(row) > len(fieldnames):
+              throw_error(f"Row at line {csv_reader.line_num} has {len(row)} cells but the header has {len(fieldnames)} columns in file '{var_path}'.")
+              continue
+            var = row[0]
+            # Missing cells are None
+            row_vals = row[1:]
+            row = {key:auto_cast_str(strip_cell(val)) for key,val in zip(row_keys, row_vals)}
+            for key in row_keys[len(row_vals):]:
+              row[key] = None
             # Handle conflits inside the file
             if var in var_dict:
               throw_warning(f"Row '{var}' redefined from '{var_dict[var]}' to '{row}' in file '{var_path}'.")
             var_dict[var] = row
         except Exception as exc:
           throw_error(f"Exception occurred while loading '{var_path}' : \n  {type(exc).__name__}\n{intend_text(exc)}")
-    except ImportError:
-      throw_error("Could not import Python library 'csv' to parse CSV/TSV variables files.")
     return var_dict
 
   def load_tsv(var_path):
@@ -212,7 +268,8 @@ def main():
   # └────────────────────────┘
 
   # Creating arguments
-  argparser = argparse.ArgumentParser()
+  import argparse
+  argparser = argparse.ArgumentParser(prog="j2gpp")
   argparser.add_argument("source",                                                        help="Source template files or directories to render",                        nargs='*')
   argparser.add_argument("-O", "--outdir",                 dest="outdir",                 help="Output directory path"                                                           )
   argparser.add_argument("-o", "--output",                 dest="output",                 help="Output file path for single source template"                                     )
@@ -228,6 +285,8 @@ def main():
   argparser.add_argument(      "--warn-overwrite",         dest="warn_overwrite",         help="Warn when overwriting files",                                           action="store_true", default=False)
   argparser.add_argument(      "--no-overwrite",           dest="no_overwrite",           help="Prevent overwriting files",                                             action="store_true", default=False)
   argparser.add_argument(      "--no-strict-undefined",    dest="no_strict_undefined",    help="Disable error with undefined variable in template",                     action="store_true", default=False)
+  argparser.add_argument(      "--cache-dir",              dest="cache_dir",              help="Directory to cache compiled templates between runs"                               )
+  argparser.add_argument(      "--no-cache",               dest="no_cache",               help="Disable caching compiled templates between runs",                       action="store_true", default=False)
   argparser.add_argument(      "--no-check-identifier",    dest="no_check_identifier",    help="Disable warning when attributes are not valid identifiers",             action="store_true", default=False)
   argparser.add_argument(      "--fix-identifiers",        dest="fix_identifiers",        help="Replace invalid characters from identifiers with underscore",           action="store_true", default=False)
   argparser.add_argument(      "--chdir-src",              dest="chdir_src",              help="Change working directory to source before rendering ",                  action="store_true", default=False)
@@ -239,11 +298,22 @@ def main():
   argparser.add_argument(      "--xml-remove-namespaces",  dest="xml_remove_namespaces",  help="Remove XML namespace prefixes from tags",                               action="store_true", default=False)
   argparser.add_argument(      "--render-non-template",    dest="render_non_template",    help="Process also source files that are not recognized as templates",        nargs='?',           default=None, const="_j2gpp")
   argparser.add_argument(      "--copy-non-template",      dest="copy_non_template",      help="Copy source files that are not templates to output directory",          action="store_true", default=False)
+  argparser.add_argument("-j", "--jobs",                   dest="jobs",                   help="Number of processes rendering templates in parallel (0 for all cores)", type=int,            default=1)
   argparser.add_argument(      "--force-glob",             dest="force_glob",             help="Glob UNIX-like patterns in path even when quoted",                      action="store_true", default=False)
+  argparser.add_argument(      "--watch",                  dest="watch",                  help="Render the templates again when they change until interrupted",         action="store_true", default=False)
   argparser.add_argument(      "--debug-vars",             dest="debug_vars",             help="Display available variables at the top of rendered templates",          action="store_true", default=False)
   argparser.add_argument(      "--perf",                   dest="perf",                   help="Measure and display performance",                                       action="store_true", default=False)
   argparser.add_argument(      "--version",                dest="version",                help="Print J2GPP version and quits",                                         action="store_true", default=False)
   argparser.add_argument(      "--license",                dest="license",                help="Print J2GPP license and quits",                                         action="store_true", default=False)
+
+  # Shell completion with argcomplete, exits before parsing and the heavy imports
+  if '_ARGCOMPLETE' in os.environ:
+    try:
+      import argcomplete
+      argcomplete.autocomplete(argparser)
+    except ImportError:
+      pass
+
   args, args_unknown = argparser.parse_known_args()
 
   if args.version:
@@ -254,6 +324,19 @@ def main():
     print_license()
     exit()
 
+  # Heavy imports after the version and license arguments that exit early
+  import glob
+  import hashlib
+  import multiprocessing
+  import shutil
+  from datetime import datetime
+  from platform import python_version
+  from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, StrictUndefined
+  from jinja2 import __version__ as jinja2_version
+  import jinja2.exceptions as jinja2_exceptions
+  from j2gpp.filters import extra_filters, write_source_toggle, export_dirpaths
+  from j2gpp.tests import extra_tests
+
   # Title after license and version argument parsing
   j2gpp_title()
   print(f"Python version :",python_version())
@@ -284,24 +367,22 @@ def main():
   out_dir = ""
   if args.outdir:
     # Get full path
-    out_dir = os.path.expandvars(os.path.expanduser(os.path.abspath(args.outdir)))
+    out_dir = get_full_path(args.outdir, pwd)
     # Create directories if needed
-    if not os.path.isdir(out_dir):
-      os.makedirs(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
     print("Output directory :\n ",out_dir)
   else:
-    print("Output directory :\n ",os.getcwd())
+    print("Output directory :\n ",pwd)
 
   # Output file if single source template
   one_out_path = ""
   if args.output:
     # Get full path
-    one_out_path = os.path.expandvars(os.path.expanduser(os.path.abspath(args.output)))
+    one_out_path = get_full_path(args.output, pwd)
     one_out_dir = os.path.dirname(one_out_path)
     # Create directories if needed
-    if not os.path.isdir(one_out_dir):
-      os.makedirs(one_out_dir)
-    print("Output file :",out_dir)
+    os.makedirs(one_out_dir, exist_ok=True)
+    print("Output file :",one_out_path)
 
   # Jinja2 include directories
   inc_dirs = []
@@ -309,11 +390,23 @@ def main():
     print("Include directories :")
     for inc_dir in args.incdir:
       # Get full path
-      inc_dir = os.path.expandvars(os.path.expanduser(os.path.abspath(inc_dir)))
+      inc_dir = get_full_path(inc_dir, pwd)
+      # Duplicates would be searched again for each template not found in the first one
+      if inc_dir in inc_dirs:
+        continue
       print(" ",inc_dir)
       inc_dirs.append(inc_dir)
   else: print("No include directory provided.")
 
+  # Compiled templates cache directory
+  cache_dir = None
+  if args.cache_dir and not args.no_cache:
+    # Get full path
+    cache_dir = get_full_path(args.cache_dir, pwd)
+    # Create directories if needed, private as the cached bytecode is executed
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    print("Compiled templates cache directory :\n ",cache_dir)
+
   # Global variable defines
   defines = []
   if args.define:
@@ -329,7 +422,7 @@ def main():
     print("Global variables files :")
     for var_path in args.varfile:
       # Get full path
-      var_path = os.path.expandvars(os.path.expanduser(os.path.abspath(var_path)))
+      var_path = get_full_path(var_path, pwd)
       print(" ",var_path)
       global_var_paths.append(var_path)
   else: print("No global variables file provided.")
@@ -348,7 +441,10 @@ def main():
     print("Extra Jinja2 filter files :")
     for filter_path in args.filters:
       # Get full path
-      filter_path = os.path.expandvars(os.path.expanduser(os.path.abspath(filter_path)))
+      filter_path = get_full_path(filter_path, pwd)
+      # Scripts are loaded once, their functions registered once
+      if filter_path in filter_paths:
+        continue
       print(" ", filter_path)
       filter_paths.append(filter_path)
 
@@ -358,7 +454,10 @@ def main():
     print("Extra Jinja2 test files :")
     for test_path in args.tests:
       # Get full path
-      test_path = os.path.expandvars(os.path.expanduser(os.path.abspath(test_path)))
+      test_path = get_full_path(test_path, pwd)
+      # Scripts are loaded once, their functions registered once
+      if test_path in test_paths:
+        continue
       print(" ", test_path)
       test_paths.append(test_path)
 
@@ -366,16 +465,30 @@ def main():
   file_vars_adapter = None
   if args.file_vars_adapter:
     file_vars_adapter = args.file_vars_adapter
-    file_vars_adapter[0] = os.path.expandvars(os.path.expanduser(os.path.abspath(file_vars_adapter[0])))
+    file_vars_adapter[0] = get_full_path(file_vars_adapter[0], pwd)
     print(f"Variables files adapter function :\n  {args.file_vars_adapter[1]} from {args.file_vars_adapter[0]}")
 
   # Global variables adapter function
   global_vars_adapter = None
   if args.global_vars_adapter:
     global_vars_adapter = args.global_vars_adapter
-    global_vars_adapter[0] = os.path.expandvars(os.path.expanduser(os.path.abspath(global_vars_adapter[0])))
+    global_vars_adapter[0] = get_full_path(global_vars_adapter[0], pwd)
     print(f"Global variables adapter function :\n  {args.global_vars_adapter[1]} from {args.global_vars_adapter[0]}")
 
+  # Parallel rendering
+  jobs = args.jobs
+  if jobs == 0:
+    jobs = os.cpu_count()
+  if jobs < 0:
+    throw_error(f"Incorrect number of jobs '{jobs}'.")
+    jobs = 1
+  elif jobs > 1:
+    if 'fork' in multiprocessing.get_all_start_methods():
+      print(f"Rendering templates with {jobs} processes in parallel.")
+    else:
+      throw_warning("Parallel rendering is not supported on this platform. Option --jobs is ignored.")
+      jobs = 1
+
   # Debug mode
   debug_vars = args.debug_vars
   if debug_vars:
@@ -386,6 +499,7 @@ def main():
   options['warn_overwrite']         = args.warn_overwrite
   options['no_strict_undefined']    = args.no_strict_undefined
   options['no_overwrite']           = args.no_overwrite
+  options['no_cache']               = args.no_cache
   options['no_check_identifier']    = args.no_check_identifier
   options['fix_identifiers']        = args.fix_identifiers
   options['chdir_src']              = args.chdir_src
@@ -398,12 +512,16 @@ def main():
   options['render_non_template']    = args.render_non_template
   options['copy_non_template']      = args.copy_non_template
   options['force_glob']             = args.force_glob
+  options['watch']                  = args.watch
 
   # Error checking command line options
   if options['overwrite_outdir'] and not out_dir:
     throw_warning("Overwrite output directory option enabled but no output directory provided. Option --overwrite-outdir is ignored.")
     options['overwrite_outdir'] = False
 
+  if args.cache_dir and options['no_cache']:
+    throw_warning("Incompatible --cache-dir and --no-cache options. Option --cache-dir is ignored.")
+
   if options['warn_overwrite'] and options['no_overwrite']:
     throw_warning("Incompatible --warn-overwrite and --no-overwrite options. Option --warn-overwrite is ignored.")
     options['warn_overwrite'] = False
@@ -427,11 +545,62 @@ def main():
   # Overload the join_path function such that the include statements are relative to the template
   class RelativeIncludeEnvironment(Environment):
     def join_path(self, template, parent):
+      # Source templates are loaded by absolute path, their includes are resolved from the include directories
+      if parent in self.loader.source_paths:
+        return template
       return os.path.join(os.path.dirname(parent), template)
 
+  # Overload the loader such that source templates can be loaded by absolute path and cached by Jinja2
+  class SourceFileLoader(FileSystemLoader):
+    # Absolute paths of the fetched source templates, other names are looked up in the include directories
+    source_paths = set()
+    # Compiled code of the source templates indexed by content hash
+    compiled_sources = {}
+    # Digest of the filters and tests the templates are compiled against
+    plugins_digest = ""
+
+    def get_source(self, environment, template):
+      if template not in self.source_paths:
+        return super().get_source(environment, template)
+      # Read raw bytes in one call and decode once, Jinja2 normalizes the newlines
+      source, src_stat = read_file_bytes(template)
+      source = source.decode(self.encoding)
+      mtime = src_stat.st_mtime
+      def uptodate():
+        try:
+          return os.path.getmtime(template) == mtime
+        except OSError:
+          return False
+      return source, template, uptodate
+
+    # Compile source templates with identical content only once
+    def load(self, environment, name, globals=None):
+      if name not in self.source_paths:
+        return super().load(environment, name, globals)
+      source, filename, uptodate = self.get_source(environment, name)
+      source_hash = hashlib.blake2b(source.encode(), digest_size=16).digest()
+      if source_hash not in self.compiled_sources:
+        # Bytecode cache from previous runs also indexed by content hash
+        bytecode_cache = environment.bytecode_cache
+        if bytecode_cache is not None:
+          # Compiled code also depends on the extensions enabled by this version of J2GPP and on the plugins
+          bucket = bytecode_cache.get_bucket(environment, f"{j2gpp_version}:{self.plugins_digest}:{source_hash.hex()}", None, source)
+          if bucket.code is None:
+            bucket.code = environment.compile(source, None, filename)
+            bytecode_cache.set_bucket(bucket)
+          self.compiled_sources[source_hash] = bucket.code
+        else:
+          self.compiled_sources[source_hash] = environment.compile(source, None, filename)
+      # Point the code to this file for the error tracebacks
+      code = code_with_filename(self.compiled_sources[source_hash], filename)
+      return environment.template_class.from_code(environment, code, environment.make_globals(globals), uptodate)
+
   # Jinja2 environment
   env = RelativeIncludeEnvironment(
-    loader=FileSystemLoader(inc_dirs)
+    loader         = SourceFileLoader(inc_dirs),
+    auto_reload    = options['watch'],
+    cache_size     = -1,
+    bytecode_cache = None if options['no_cache'] else FileSystemBytecodeCache(cache_dir, '__j2gpp_%s.cache')
   )
   env.add_extension('jinja2.ext.do')
   env.add_extension('jinja2.ext.debug')
@@ -457,7 +626,7 @@ def main():
     filters = {}
     for filter_path in filter_paths:
       if os.path.isfile(filter_path):
-        filter_module = imp.load_source("", filter_path)
+        filter_module = load_source_module(filter_path)
         for filter_name in dir(filter_module):
           if filter_name[0] != '_':
             print(f"Loading filter '{filter_name}' from '{filter_path}'.")
@@ -472,7 +641,7 @@ def main():
     tests = {}
     for test_path in test_paths:
       if os.path.isfile(test_path):
-        test_module = imp.load_source("", test_path)
+        test_module = load_source_module(test_path)
         for test_name in dir(test_module):
           if test_name[0] != '_':
             test_function = getattr(test_module, test_name)
@@ -482,6 +651,19 @@ def main():
               tests[test_name] = test_function
     env.tests.update(tests)
 
+  # Filters and tests calls are compiled in the templates, cache the compiled templates separately for each set of plugins
+  if env.bytecode_cache is not None:
+    # The extensions enabled by this version of J2GPP also apply to the templates of the include directories
+    plugins_hash = hashlib.blake2b(f"{j2gpp_version}\0".encode(), digest_size=8)
+    for plugin_path in filter_paths + test_paths:
+      if os.path.isfile(plugin_path):
+        plugins_hash.update(plugin_path.encode() + b'\0' + read_file_bytes(plugin_path)[0] + b'\0')
+    for plugin_kind, plugin_functions in (('filter', env.filters), ('test', env.tests)):
+      for plugin_name, plugin_function in sorted(plugin_functions.items()):
+        plugins_hash.update(f"{plugin_kind}:{plugin_name}:{getattr(plugin_function, 'jinja_pass_arg', None)}\0".encode())
+    env.loader.plugins_digest = plugins_hash.hexdigest()
+    env.bytecode_cache = FileSystemBytecodeCache(cache_dir, f'__j2gpp_{env.loader.plugins_digest}_%s.cache')
+
   # Variables files adapter function
   file_vars_adapter_function = None
   if file_vars_adapter:
@@ -489,7 +671,7 @@ def main():
     file_vars_adapter_name = file_vars_adapter[1]
     print(f"Loading variables file adapter function '{file_vars_adapter_name}' from '{file_vars_adapter_path}'.")
     try:
-      file_vars_adapter_module = imp.load_source("", file_vars_adapter_path)
+      file_vars_adapter_module = load_source_module(file_vars_adapter_path)
       file_vars_adapter_function = getattr(file_vars_adapter_module, file_vars_adapter_name)
       if not callable(file_vars_adapter_function):
         throw_error(f"Object '{file_vars_adapter_name}' from '{file_vars_adapter_path}' is not a function.")
@@ -508,7 +690,7 @@ def main():
     global_vars_adapter_name = global_vars_adapter[1]
     print(f"Loading global variables adapter function '{global_vars_adapter_name}' from '{global_vars_adapter_path}'.")
     try:
-      global_vars_adapter_module = imp.load_source("", global_vars_adapter_path)
+      global_vars_adapter_module = load_source_module(global_vars_adapter_path)
       global_vars_adapter_function = getattr(global_vars_adapter_module, global_vars_adapter_name)
       if not callable(global_vars_adapter_function):
         throw_error(f"Object '{global_vars_adapter_name}' from '{global_vars_adapter_path}' is not a function.")
@@ -543,26 +725,34 @@ def main():
       out_path = src_path
     elif options['render_non_template']:
       print(f"Found non-template source file {src_path}")
-      # Add the option suffix before file extensions if present
-      if '.' in src_path:
-        out_path = src_path.replace('.', options['render_non_template']+'.', 1)
-      else:
-        out_path = src_path + options['render_non_template']
+      # Add the option suffix before file extensions if present, in the file name and not the directories
+      src_dirpath, src_filename = os.path.split(src_path)
+      src_stem, sep, src_extensions = src_filename.partition('.')
+      out_path = os.path.join(src_dirpath, src_stem + options['render_non_template'] + sep + src_extensions)
     else:
       if warn_non_template:
         throw_warning(f"Source file '{src_path}' is not a template.")
       return
 
+    # Providing output file name
+    if one_out_path:
+      out_path = one_out_path
     # Providing output directory
-    if out_dir:
+    elif out_dir:
       if dir_path:
-        out_path = os.path.join(out_dir, os.path.relpath(out_path, dir_path))
+        # Files found by scanning the directory are prefixed by its path, no need to resolve the relative path
+        dir_prefix = os.path.join(dir_path, '')
+        if out_path.startswith(dir_prefix):
+          out_path = os.path.join(out_dir, out_path[len(dir_prefix):])
+        else:
+          out_path = os.path.join(out_dir, os.path.relpath(out_path, dir_path))
       else:
         out_path = os.path.join(out_dir, os.path.basename(out_path))
 
-    # Providing output file name
-    if one_out_path:
-      out_path = one_out_path
+    # Source fetched again by overlapping arguments is rendered only once
+    if (src_path, out_path) in fetched_paths:
+      return
+    fetched_paths.add((src_path, out_path))
 
     # Dict structure for each source template
     src_dict = {
@@ -576,41 +766,63 @@ def main():
 
   # Fetch directory of source files
   def fetch_source_directory(dir_path):
-    # Read and execute permission required
-    if not os.access(dir_path, os.R_OK | os.X_OK):
-      throw_error(f"Missing access permissions for source directory '{dir_path}'.")
-    else:
-      print(f"Found source directory {dir_path}")
-      for subdir, dirs, files in os.walk(dir_path):
-        for src_path in files:
-          abs_path = os.path.join(subdir, src_path)
-          fetch_source_file(abs_path, dir_path)
+    print(f"Found source directory {dir_path}")
+    # Depth-first traversal with a stack of directories, using the file types cached by scandir
+    subdir_stack = [dir_path]
+    # Non-template files are filtered out by name during the scan when they are ignored
+    fetch_non_templates = options['copy_non_template'] or options['render_non_template']
+    while subdir_stack:
+      subdir_path = subdir_stack.pop()
+      subdir_paths = []
+      try:
+        with os.scandir(subdir_path) as entries:
+          for entry in entries:
+            if entry.is_dir():
+              # Symbolic links to directories are not followed
+              if not entry.is_symlink():
+                subdir_paths.append(entry.path)
+            elif fetch_non_templates or entry.name.endswith('.j2'):
+              fetch_source_file(entry.path, dir_path)
+      except PermissionError:
+        throw_error(f"Missing access permissions for source directory '{subdir_path}'.")
+        continue
+      except OSError:
+        continue
+      subdir_stack.extend(reversed(subdir_paths))
 
   # Fetch source file or directory
   def fetch_source(src_path, warn_non_template=False):
-    if os.path.isdir(src_path):
+    # Single stat call for both file type tests
+    try:
+      src_mode = os.stat(src_path).st_mode
+    except (OSError, ValueError):
+      src_mode = 0
+    if stat.S_ISDIR(src_mode):
       fetch_source_directory(src_path)
-    elif os.path.isfile(src_path):
+    elif stat.S_ISREG(src_mode):
       fetch_source_file(src_path, warn_non_template=warn_non_template)
     else:
       throw_error(f"Unresolved source '{src_path}'.")
 
-  # Collecting source templates paths
-  for raw_path in arg_source:
-    if options['force_glob']:
-      # Glob to apply UNIX-style path patterns
-      for glob_path in glob.glob(raw_path):
-        abs_path = os.path.abspath(glob_path)
+  # Collecting source templates paths, repeated arguments are only fetched once
+  for raw_path in dict.fromkeys(arg_source):
+    # Skip globbing literal paths
+    if options['force_glob'] and path_has_glob(raw_path):
+      # Glob to apply UNIX-style path patterns, overlapping patterns are deduplicated when fetching
+      for glob_path in glob.iglob(raw_path, recursive=True):
+        abs_path = get_abs_path(glob_path, pwd)
         fetch_source(abs_path)
     else:
-      abs_path = os.path.abspath(raw_path)
+      abs_path = get_abs_path(raw_path, pwd)
       fetch_source(abs_path, warn_non_template=True)
 
   # Some checking
   if len(sources) == 0 and len(to_copy) == 0:
     throw_error(f"No source template found.")
   elif one_out_path and len(sources) > 1:
+    # Each template would overwrite the output of the previous one
     throw_error(f"Multiple source templates provided alongside -o/--output argument.")
+    exit()
 
 
 
@@ -620,40 +832,53 @@ def main():
 
   throw_h2("Loading variables")
 
-  # Merge two dictionaries
+  # Marker for keys missing from a dictionary
+  var_dict_missing = object()
+
+  # Merge the second dictionary into the first one in place
   def var_dict_update(var_dict1, var_dict2, val_scope="", context=""):
-    var_dict_res = var_dict1
-    for key,val in var_dict2.items():
-      # Conflict
-      if key in var_dict1.keys() and var_dict1[key] != val:
-        val_ori = var_dict1[key]
-        # Recursively merge dictionary
+    # No common keys so nothing to merge deeply or to warn about, like environment variables
+    if type(var_dict1) is dict and var_dict1.keys().isdisjoint(var_dict2):
+      var_dict1.update(var_dict2)
+      return var_dict1
+    # Stack of nested dictionaries to merge
+    merge_stack = [(var_dict1, var_dict2, val_scope)]
+    while merge_stack:
+      var_dict_dst, var_dict_src, val_scope = merge_stack.pop()
+      for key,val in var_dict_src.items():
+        val_ori = var_dict_dst.get(key, var_dict_missing)
+        # Merge nested dictionaries later, without comparing them deeply first
         if isinstance(val_ori, dict) and isinstance(val, dict):
-          val_scope = f"{val_scope}{key}."
-          var_dict_res[key] = var_dict_update(val_ori, val, val_scope, context)
-        else:
-          var_dict_res[key] = val
+          merge_stack.append((val_ori, val, f"{val_scope}{key}."))
+          continue
+        var_dict_dst[key] = val
+        # Conflict
+        if val_ori is not var_dict_missing and val_ori != val:
           throw_warning(f"Variable '{val_scope}{key}' got overwritten from '{val_ori}' to '{val}'{context}.")
-      else:
-        var_dict_res[key] = val
-    return var_dict_res
+    return var_dict1
 
   # Check that attributes names are valid Python identifier that can be accessed in Jinja2
-  def rec_check_valid_identifier(var_dict, context_file=None, val_scope=""):
-    for key, val in var_dict.copy().items():
-      # Valid identifier contains only alphanumeric letters and underscores, and cannot start with a number
-      if not key.isidentifier():
-        if options['fix_identifiers']:
-          key_valid = re.sub('\W|^(?=\d)','_', key)
-          var_dict[key_valid] = val
-          del var_dict[key]
-          key = key_valid
-        else:
-          throw_warning(f"Variable '{val_scope}{key}' from '{context_file}' is not a valid Python identifier and may not be accessible in the templates.")
-      if isinstance(val, dict):
-        val_scope = f"{val_scope}{key}."
-        # Traverse the dictionary recursively
-        rec_check_valid_identifier(var_dict[key], context_file, val_scope)
+  def check_valid_identifiers(var_dict, context_file=None):
+    # Stack of iterators over the nested dictionaries, keys are renamed while iterating when fixing them
+    check_stack = [(iter(list(var_dict.items())), var_dict, "")]
+    while check_stack:
+      var_items, var_dict, val_scope = check_stack[-1]
+      for key, val in var_items:
+        # Valid identifier contains only alphanumeric letters and underscores, and cannot start with a number
+        if not key.isidentifier():
+          if options['fix_identifiers']:
+            key_valid = re.sub(r'\W|^(?=\d)','_', key)
+            var_dict[key_valid] = val
+            del var_dict[key]
+            key = key_valid
+          else:
+            throw_warning(f"Variable '{val_scope}{key}' from '{context_file}' is not a valid Python identifier and may not be accessible in the templates.")
+        if isinstance(val, dict):
+          # Traverse the nested dictionary before the next keys
+          check_stack.append((iter(list(val.items())), val, f"{val_scope}{key}."))
+          break
+      else:
+        check_stack.pop()
 
   # Handle hierarchical includes of variables files
   load_var_file = None
@@ -672,7 +897,7 @@ def main():
           # Recursively load the variable file (including its preprocessing)
           inc_var_dict = load_var_file(var_path)
           # Update the variables dictionary
-          var_dict = var_dict_update(var_dict, inc_var_dict, context=f" when including '{var_path}' from '{context_file}'")
+          var_dict_update(var_dict, inc_var_dict, context=f" when including '{var_path}' from '{context_file}'")
       elif isinstance(val, dict):
         # Traverse the dictionary recursively
         rec_hierarchical_vars(val, context_file)
@@ -686,14 +911,15 @@ def main():
       file_vars_adapter_function(var_dict)
     # Check attributes are valid identifier
     if not options['no_check_identifier']:
-      rec_check_valid_identifier(var_dict, context_file)
+      check_valid_identifiers(var_dict, context_file)
 
   # Load variables from a file and return the dictionary
   def load_var_file(var_path):
     var_dict = {}
-    var_format = var_path.split('.')[-1]
-    if var_format in loaders:
-      loader = loaders[var_format]
+    # Extensions are case insensitive
+    var_format = var_path.rpartition('.')[2].lower()
+    loader = loaders.get(var_format)
+    if loader:
       try:
         var_dict = loader(var_path)
         vars_post_load_processor(var_dict, var_path)
@@ -710,21 +936,25 @@ def main():
 
   # Setting context global variables
   print(f"Setting context global variables.")
+  # Single instant formatted once for the date and time variables
+  now = datetime.now()
+  now_date_inv = now.strftime("%Y-%m-%d")
+  now_time = now.strftime("%H:%M:%S")
   context_dict = {
     '__python_version__'    : python_version(),
     '__jinja2_version__'    : jinja2_version,
     '__j2gpp_version__'     : j2gpp_version,
-    '__user__'              : os.getlogin(),
+    '__user__'              : get_user_name(),
     '__pid__'               : os.getpid(),
     '__ppid__'              : os.getppid(),
-    '__working_directory__' : os.getcwd(),
-    '__output_directory__'  : out_dir if out_dir else os.getcwd(),
-    '__date__'              : datetime.now().strftime("%d-%m-%Y"),
-    '__date_inv__'          : datetime.now().strftime("%Y-%m-%d"),
-    '__time__'              : datetime.now().strftime("%H:%M:%S"),
-    '__datetime__'          : datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    '__working_directory__' : pwd,
+    '__output_directory__'  : out_dir if out_dir else pwd,
+    '__date__'              : now.strftime("%d-%m-%Y"),
+    '__date_inv__'          : now_date_inv,
+    '__time__'              : now_time,
+    '__datetime__'          : f"{now_date_inv} {now_time}",
   }
-  global_vars = var_dict_update(global_vars, context_dict, context=f" when setting context variables")
+  var_dict_update(global_vars, context_dict, context=f" when setting context variables")
 
   # Loading global variables from environment variables
   if envvar_raw:
@@ -737,37 +967,37 @@ def main():
     if envvar_obj:
       envvar_dict = {envvar_obj: envvar_dict}
     # Merge with global variables dictionary
-    global_vars = var_dict_update(global_vars, envvar_dict, context=f" when loading environment variables")
+    var_dict_update(global_vars, envvar_dict, context=f" when loading environment variables")
 
   # Loading global variables from files
   for var_path in global_var_paths:
     print(f"Loading global variables file '{var_path}'")
     var_dict = load_var_file(var_path)
-    global_vars = var_dict_update(global_vars, var_dict, context=f" when loading global variables file '{var_path}'")
+    var_dict_update(global_vars, var_dict, context=f" when loading global variables file '{var_path}'")
 
   # Loading global variables from define
   if defines:
     print(f"Loading global variables from command line defines.")
+    define_vars = {}
     for define in defines:
-      # Defines in the format name=value
-      if '=' not in define:
+      # Defines in the format name=value, the value can contain '='
+      var, sep, val = define.partition('=')
+      if not sep:
         throw_error(f"Incorrect define argument format for '{define}'.")
         continue
-      var, val = define.split('=')
-      var_dict = {}
       # Evaluate value to correct type
-      val = auto_cast_str(val)
+      var_dict = auto_cast_str(val)
       # Interpret dot as dictionary depth
-      var_keys = var.split('.')[::-1]
-      var_dict = {var_keys[0]:val}
-      for var_key in var_keys[1:]:
+      for var_key in reversed(var.split('.')):
         var_dict = {var_key:var_dict}
-      # Merge with global variables dictionary
-      global_vars = var_dict_update(global_vars, var_dict, context=f" when loading global command line defines")
+      # Gather the defines first to merge them with the global variables only once
+      var_dict_update(define_vars, var_dict, context=f" when loading global command line defines")
+    # Merge with global variables dictionary
+    var_dict_update(global_vars, define_vars, context=f" when loading global command line defines")
 
   # User global variables adapter function
   if global_vars_adapter_function:
-    global_vars_adapter_function(var_dict)
+    global_vars_adapter_function(global_vars)
 
 
 
@@ -777,16 +1007,36 @@ def main():
 
   throw_h2("Rendering templates")
 
+  # Global variables are read-only from now on and shared by all templates
+  global_vars_view = MappingProxyType(global_vars)
+
+  # Render template with the variables used as context without copying them
+  def render_template(template, template_vars):
+    context = template.new_context(ChainMap(*template_vars.maps, template.globals), shared=True)
+    try:
+      return env.concat(template.root_render_func(context))
+    except Exception:
+      # Rewrite the traceback to the template lines
+      env.handle_exception()
+
   # Option to overwrite the output directory
   if options['overwrite_outdir']:
     print(f"Overwriting output directory.")
     try:
-      shutil.rmtree(out_dir)
+      remove_directory_tree(out_dir)
     except Exception as exc:
       throw_error(f"Cannot remove output directory '{out_dir}'.")
 
-  # Render all templates
-  for src_dict in sources:
+  # Create the directories of the output paths once instead of for each file
+  def make_output_directories(path_dicts):
+    for out_dirpath in dict.fromkeys(os.path.dirname(path_dict['out_path']) for path_dict in path_dicts):
+      try:
+        os.makedirs(out_dirpath, exist_ok=True)
+      except OSError as exc:
+        throw_error(f"Cannot create directory '{out_dirpath}'.")
+
+  # Render a single template
+  def render_source(src_dict):
     src_path = src_dict['src_path']
     out_path = src_dict['out_path']
     print(f"Rendering {src_path} \n       to {out_path}")
@@ -797,12 +1047,6 @@ def main():
     # Do render the source template, can be skipped by export filter option
     write_source_toggle[0] = True
 
-    # Create directories for output path
-    try:
-      os.makedirs(out_dirpath, exist_ok=True)
-    except OSError as exc:
-        throw_error(f"Cannot create directory '{out_dirpath}'.")
-
     # Change working directory to output directory for filters and accessory functions
     if options['no_chdir']:
       pass
@@ -811,23 +1055,22 @@ def main():
     else:
       change_working_directory(out_dirpath)
 
-    # Add context variables specific to this template
-    src_vars = global_vars.copy()
+    # Add context variables specific to this template on top of the shared global variables
+    src_vars = ChainMap({}, global_vars_view)
     src_context_vars = {
       '__source_path__': src_path,
       '__output_path__': out_path,
     }
-    src_vars = var_dict_update(src_vars, src_context_vars, context=f" when loading context variables for template {src_path}")
+    var_dict_update(src_vars, src_context_vars, context=f" when loading context variables for template {src_path}")
 
     # Output variables for debug purposes
     if debug_vars:
-      src_res += str(src_vars) + 10*'\n'
+      src_res += str(dict(src_vars)) + 10*'\n'
 
     # Render template to string
     try:
-      with open(src_path,'r') as src_file:
-        # Jinja2 rendering from string
-        src_res += env.from_string(src_file.read()).render(src_vars)
+      # Jinja2 rendering from the compiled template cache
+      src_res += render_template(env.get_template(src_path), src_vars)
     except jinja2_exceptions.UndefinedError as exc:
       # Undefined object encountered during rendering
       traceback = jinja2_render_traceback(src_path)
@@ -855,20 +1098,23 @@ def main():
 
     if not write_source_toggle[0]:
       print(f"Not writting file '{out_path}' becaused skipped by exported block.")
-      continue
+      return
 
     # If file already exists
     if os.path.exists(out_path):
+      # Keep the modification time of unchanged files for build systems
+      if file_content_equals(out_path, src_res):
+        print(f"Output file '{out_path}' is unchanged.")
+        return
       if options['warn_overwrite']:
         throw_warning(f"Output file '{out_path}' already exists and will be overwritten.")
       elif options['no_overwrite']:
         throw_warning(f"Output file '{out_path}' already exists and will not be overwritten.")
-        continue
+        return
 
     # Write the rendered file
     try:
-      with open(out_path,'w') as out_file:
-        out_file.write(src_res)
+      write_file_atomic(out_path, src_res)
     except OSError as exc:
       # Catch file write exceptions
       if exc.errno == errno.EISDIR:
@@ -878,11 +1124,37 @@ def main():
       else:
         throw_error(f"Cannot write '{out_path}'.")
 
-  # Restore command working directory
-  change_working_directory(pwd)
+  # Render all templates
+  def render_sources():
+    global render_worker_function
+    env.loader.source_paths.update(src_dict['src_path'] for src_dict in sources)
+    # The output directories may have been removed since the previous rendering
+    export_dirpaths.clear()
+    make_output_directories(sources)
+    if jobs > 1:
+      # Worker processes inherit the environment and variables by forking
+      from concurrent.futures import ProcessPoolExecutor
+      render_worker_function = render_source
+      sys.stdout.flush()
+      with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('fork')) as executor:
+        # Send the sources by batches to reduce the communication between processes
+        chunksize = max(1, len(sources) // (4 * jobs))
+        for src_log, src_errors, src_warnings in executor.map(render_worker, sources, chunksize=chunksize):
+          print(src_log, end='')
+          errors.extend(src_errors)
+          warnings.extend(src_warnings)
+    else:
+      for src_dict in sources:
+        render_source(src_dict)
+
+    # Restore command working directory
+    change_working_directory(pwd)
+
+  render_sources()
 
   # If option is set, copy the non-template files
   if options['copy_non_template']:
+    make_output_directories(to_copy)
     for cpy_dict in to_copy:
       cpy_path = cpy_dict['src_path']
       out_path = cpy_dict['out_path']
@@ -899,8 +1171,7 @@ def main():
 
       # Copying the file
       try:
-        os.makedirs(os.path.dirname(out_path), exist_ok=True)
-        shutil.copyfile(cpy_path, out_path)
+        copy_file(cpy_path, out_path)
       except shutil.SameFileError as exc:
         throw_error(f"Cannot write '{out_path}' : source and destination paths are identical.")
       except OSError as exc:
@@ -914,6 +1185,42 @@ def main():
 
 
 
+  # ┌───────────────────────┐
+  # │ Watching source files │
+  # └───────────────────────┘
+
+  # Modification times of the source templates and the files in include directories
+  def get_watched_mtimes():
+    watched_paths = [src_dict['src_path'] for src_dict in sources]
+    for inc_dir in inc_dirs:
+      for subdir, dirs, files in os.walk(inc_dir):
+        watched_paths += [os.path.join(subdir, inc_path) for inc_path in files]
+    watched_mtimes = {}
+    for watched_path in watched_paths:
+      try:
+        watched_mtimes[watched_path] = os.stat(watched_path).st_mtime_ns
+      except OSError:
+        watched_mtimes[watched_path] = None
+    return watched_mtimes
+
+  # Render again when a template changes, reusing the environment and its compiled templates
+  if options['watch']:
+    throw_h2("Watching source files")
+    print("Rendering the templates again when they change. Press Ctrl+C to stop.")
+    watched_mtimes = get_watched_mtimes()
+    try:
+      while True:
+        time.sleep(1)
+        new_watched_mtimes = get_watched_mtimes()
+        if new_watched_mtimes != watched_mtimes:
+          watched_mtimes = new_watched_mtimes
+          throw_h2("Rendering templates")
+          render_sources()
+    except KeyboardInterrupt:
+      print("Stopped watching source files.")
+
+
+
   # ┌─────┐
   # │ End │
   # └─────┘
@@ -15,8 +15,11 @@ import time
 import ast
 import os
 import re
+import stat
 import errno
+import functools
 from sys import exc_info
+from types import CodeType
 
 
 
@@ -83,49 +86,39 @@ def throw_h3(text, min_width=40):
 warnings = []
 errors = []
 
-# Cool looking messages
+# Cool looking messages, each written in a single call
 def throw_note(text):
-  print(ansi_codes['blue']+ansi_codes['bold'], end='')
-  print(f"NOTE:",text)
-  print(ansi_codes['reset'], end='')
+  print(f"{ansi_codes['blue']}{ansi_codes['bold']}NOTE: {text}\n{ansi_codes['reset']}", end='')
 
 def throw_done(text):
-  print(ansi_codes['green']+ansi_codes['bold'], end='')
-  print(f"DONE:",text)
-  print(ansi_codes['reset'], end='')
+  print(f"{ansi_codes['green']}{ansi_codes['bold']}DONE: {text}\n{ansi_codes['reset']}", end='')
 
 def throw_warning(text):
   global warnings
   warnings.append(text)
-  print(ansi_codes['yellow']+ansi_codes['bold'], end='')
-  print(f"WARNING:",text)
-  print(ansi_codes['reset'], end='')
+  print(f"{ansi_codes['yellow']}{ansi_codes['bold']}WARNING: {text}\n{ansi_codes['reset']}", end='')
 
 def throw_error(text):
   global errors
   errors.append(text)
-  print(ansi_codes['red']+ansi_codes['bold'], end='')
-  print(f"ERROR:",text)
-  print(ansi_codes['reset'], end='')
+  print(f"{ansi_codes['red']}{ansi_codes['bold']}ERROR: {text}\n{ansi_codes['reset']}", end='')
 
 def throw_fatal(text):
-  print(ansi_codes['red']+ansi_codes['bold']+ansi_codes['reversed']+ansi_codes['slowblink'], end='')
-  print(f"FATAL:",text)
-  print(ansi_codes['reset'], end='')
+  print(f"{ansi_codes['red']}{ansi_codes['bold']}{ansi_codes['reversed']}{ansi_codes['slowblink']}FATAL: {text}\n{ansi_codes['reset']}", end='')
 
 def error_warning_summary():
-  print("Warnings:", ansi_codes['yellow']+ansi_codes['bold']+ansi_codes['reversed'], len(warnings), ansi_codes['reset'],
-        "Errors:",   ansi_codes['red']   +ansi_codes['bold']+ansi_codes['reversed'], len(errors),   ansi_codes['reset'])
-  print(ansi_codes['yellow']+ansi_codes['bold'], end='')
+  counts = " ".join(["Warnings:", ansi_codes['yellow']+ansi_codes['bold']+ansi_codes['reversed'], str(len(warnings)), ansi_codes['reset'],
+                     "Errors:",   ansi_codes['red']   +ansi_codes['bold']+ansi_codes['reversed'], str(len(errors)),   ansi_codes['reset']])
+  # Single write for the whole summary instead of one per message
+  summary = [counts, "\n", ansi_codes['yellow']+ansi_codes['bold']]
   for warning in warnings:
-    print(f"WARNING:",warning)
-  print(ansi_codes['reset'], end='')
-  print(ansi_codes['red']+ansi_codes['bold'], end='')
+    summary.append(f"WARNING: {warning}\n")
+  summary.append(ansi_codes['reset'] + ansi_codes['red']+ansi_codes['bold'])
   for error in errors:
-    print(f"ERROR:",error)
-  print(ansi_codes['reset'], end='')
-  print("Warnings:", ansi_codes['yellow']+ansi_codes['bold']+ansi_codes['reversed'], len(warnings), ansi_codes['reset'],
-        "Errors:",   ansi_codes['red']   +ansi_codes['bold']+ansi_codes['reversed'], len(errors),   ansi_codes['reset'])
+    summary.append(f"ERROR: {error}\n")
+  summary.append(ansi_codes['reset'])
+  summary.append(counts + "\n")
+  print("".join(summary), end='')
 
 # Intend block of text
 def intend_text(text):
@@ -169,13 +162,43 @@ def str_isfloat(str):
   except ValueError:
     return False
 
+# Python constants cast without evaluating the syntax
+auto_cast_constants = {
+  'True':  True,
+  'False': False,
+  'None':  None,
+}
+
+# First characters a Python literal can start with after whitespace, including constants, set() and string prefixes
+auto_cast_literal_chars = frozenset('0123456789+-.\'"[{(#\\bBrRuUTFNs')
+
+# Immutable results of previous casts, keyed by the string
+auto_cast_cache = {}
+auto_cast_cache_size = 16384
+auto_cast_cache_types = (int, float, complex, str, bytes)
+
 # Cast to Python type according to syntax
 def auto_cast_str(val):
+  if not isinstance(val, str):
+    return val
+  if val in auto_cast_constants:
+    return auto_cast_constants[val]
+  # Decimal integers without leading zeros, which are invalid Python syntax
+  if val.isdecimal() and val.isascii() and (val[0] != '0' or val == '0'):
+    return int(val)
+  # Plain words cannot be literals, ignoring the whitespace around them
+  if val.strip()[:1] not in auto_cast_literal_chars:
+    return val
+  if val in auto_cast_cache:
+    return auto_cast_cache[val]
   try:
-    val = ast.literal_eval(val)
+    res = ast.literal_eval(val)
   except:
-    pass
-  return val
+    res = val
+  # Containers are mutable and must not be shared between variables
+  if type(res) in auto_cast_cache_types and len(auto_cast_cache) < auto_cast_cache_size:
+    auto_cast_cache[val] = res
+  return res
 
 
 
@@ -184,10 +207,10 @@ def auto_cast_str(val):
 # └─────────────┘
 
 def perf_counter_start():
-  return time.process_time_ns()
+  return time.perf_counter_ns()
 
 def perf_counter_stop(start_time):
-  stop_time = time.process_time_ns()
+  stop_time = time.perf_counter_ns()
   return stop_time - start_time
 
 def perf_counter_print(counter_time):
@@ -199,6 +222,179 @@ def perf_counter_print(counter_time):
 # │ Files and directories │
 # └───────────────────────┘
 
+# Buffer size for reading and writing whole rendered files
+file_buffer_size = 1 << 17
+
+# Get absolute path relative to a known working directory without querying it again
+def get_abs_path(path, cwd=None):
+  if not os.path.isabs(path):
+    path = os.path.join(cwd or os.getcwd(), path)
+  return os.path.normpath(path)
+
+# Expand environment variables and user home directory, independent of the working directory
+@functools.lru_cache(maxsize=None)
+def expand_path(path):
+  return os.path.expanduser(os.path.expandvars(path))
+
+# Get absolute path with environment variables and user home directory expanded
+def get_full_path(path, cwd=None):
+  return get_abs_path(expand_path(path), cwd)
+
+# Tests if path contains UNIX-like pattern characters
+glob_magic_chars = frozenset('*?[')
+def path_has_glob(path):
+  return not glob_magic_chars.isdisjoint(path)
+
+# Modules loaded from script files, keyed by path and modification time
+loaded_source_modules = {}
+
+# Load Python module from a script file, executed once even if used for filters, tests and adapters
+def load_source_module(module_path):
+  import importlib.util
+  from importlib.machinery import SourceFileLoader
+  module_key = (module_path, os.stat(module_path).st_mtime_ns)
+  if module_key in loaded_source_modules:
+    return loaded_source_modules[module_key]
+  module_name = os.path.splitext(os.path.basename(module_path))[0]
+  module_loader = SourceFileLoader(module_name, module_path)
+  module = importlib.util.module_from_spec(importlib.util.spec_from_loader(module_name, module_loader))
+  module_loader.exec_module(module)
+  loaded_source_modules[module_key] = module
+  return module
+
+# Read a whole file in a single system call sized by its status, also returned
+def read_file_bytes(file_path):
+  fd = os.open(file_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+  try:
+    file_stat = os.fstat(fd)
+    content = os.read(fd, file_stat.st_size + 1)
+    # File larger than its status, grown since or special file
+    if len(content) > file_stat.st_size:
+      chunks = [content]
+      chunk = os.read(fd, file_buffer_size)
+      while chunk:
+        chunks.append(chunk)
+        chunk = os.read(fd, file_buffer_size)
+      content = b''.join(chunks)
+    return content, file_stat
+  finally:
+    os.close(fd)
+
+# Tests if the content of a file is identical to a string
+def file_content_equals(file_path, content, chunk_size=65536):
+  try:
+    # Only regular files, reading a device or a pipe could block or consume its data
+    if not stat.S_ISREG(os.stat(file_path).st_mode):
+      return False
+    # No newline translation such that the line endings of the file are compared too
+    # The content is written in text mode, with the newlines of the platform
+    if os.linesep != '\n':
+      content = content.replace('\n', os.linesep)
+    with open(file_path, buffering=file_buffer_size, newline='') as file:
+      # Compare by chunks to stop at the first difference without reading the whole file
+      for offset in range(0, len(content), chunk_size):
+        if file.read(chunk_size) != content[offset:offset+chunk_size]:
+          return False
+      # File must not be longer than the content
+      return not file.read(1)
+  except (OSError, UnicodeDecodeError):
+    return False
+
+# Write file directly to the destination
+def write_file_in_place(file_path, content):
+  with open(file_path, 'w', buffering=file_buffer_size) as file:
+    file.write(content)
+
+# Write file through a temporary file renamed over the destination, such that it is never partially written
+def write_file_atomic(file_path, content):
+  import tempfile
+  # Devices, pipes and other special files cannot be replaced, write them in place
+  # Read-only files would be replaced regardless of their permissions, opening them in place raises the error
+  try:
+    if not stat.S_ISREG(os.stat(file_path).st_mode) or not os.access(file_path, os.W_OK):
+      return write_file_in_place(file_path, content)
+  except FileNotFoundError:
+    pass
+  # Write through symbolic links
+  file_path = os.path.realpath(file_path)
+  try:
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix=f".{os.path.basename(file_path)}.", suffix=".tmp")
+  except OSError as exc:
+    # The directory is not writable but the file itself can be
+    if exc.errno in (errno.EACCES, errno.EPERM):
+      return write_file_in_place(file_path, content)
+    raise
+  try:
+    with os.fdopen(tmp_fd, 'w', buffering=file_buffer_size) as tmp_file:
+      tmp_file.write(content)
+    # Temporary files are private, use the permissions of the replaced file or the default ones
+    try:
+      os.chmod(tmp_path, stat.S_IMODE(os.stat(file_path).st_mode))
+    except FileNotFoundError:
+      umask = os.umask(0)
+      os.umask(umask)
+      os.chmod(tmp_path, 0o666 & ~umask)
+    os.replace(tmp_path, file_path)
+  except BaseException:
+    os.unlink(tmp_path)
+    raise
+
+# Copy a file, letting the kernel copy or share the data blocks when possible
+def copy_file(src_path, dst_path):
+  import shutil
+  copy_file_range = getattr(os, 'copy_file_range', None)
+  if copy_file_range is not None:
+    if os.path.exists(dst_path) and os.path.samefile(src_path, dst_path):
+      raise shutil.SameFileError(f"'{src_path}' and '{dst_path}' are the same file")
+    with open(src_path, 'rb') as src_file, open(dst_path, 'wb') as dst_file:
+      try:
+        # Copy-on-write filesystems can share the blocks instead of copying them
+        while copy_file_range(src_file.fileno(), dst_file.fileno(), 1 << 30):
+          pass
+        return
+      except OSError as exc:
+        # Unsupported between these files, the generic copy below truncates and restarts
+        if exc.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+          raise
+  shutil.copyfile(src_path, dst_path)
+
+# Remove a directory tree, the files being deleted in parallel by threads as unlink releases the GIL
+def remove_directory_tree(dir_path):
+  from concurrent.futures import ThreadPoolExecutor
+  if os.path.islink(dir_path):
+    raise OSError(f"Cannot remove symbolic link to directory '{dir_path}'.")
+  file_paths = []
+  subdir_paths = []
+  scan_stack = [dir_path]
+  while scan_stack:
+    scan_path = scan_stack.pop()
+    subdir_paths.append(scan_path)
+    with os.scandir(scan_path) as entries:
+      for entry in entries:
+        # Symbolic links to directories are removed and not followed
+        if entry.is_dir(follow_symlinks=False):
+          scan_stack.append(entry.path)
+        else:
+          file_paths.append(entry.path)
+  with ThreadPoolExecutor() as executor:
+    # Consume the results to raise the first exception
+    for _ in executor.map(os.unlink, file_paths):
+      pass
+  # Subdirectories are always scanned after their parent
+  for subdir_path in reversed(subdir_paths):
+    os.rmdir(subdir_path)
+
+# Name of the current user, also without a controlling terminal like in containers and CI jobs
+def get_user_name():
+  try:
+    return os.getlogin()
+  except OSError:
+    import getpass
+    try:
+      return getpass.getuser()
+    except Exception:
+      return ""
+
 # Change working directory with exception handling
 def change_working_directory(dir_path):
   try:
@@ -217,6 +413,16 @@ def change_working_directory(dir_path):
 # │ Error handling │
 # └────────────────┘
 
+# Copy compiled code and its nested functions with another file name
+def code_with_filename(code, filename):
+  consts = tuple(code_with_filename(const, filename) if isinstance(const, CodeType) else const for const in code.co_consts)
+  if hasattr(code, 'replace'):
+    return code.replace(co_filename=filename, co_consts=consts)
+  # Python 3.7 has no replace method, rebuild the code object with its constructor arguments
+  return CodeType(code.co_argcount, code.co_kwonlyargcount, code.co_nlocals, code.co_stacksize, code.co_flags,
+                  code.co_code, consts, code.co_names, code.co_varnames, filename, code.co_name,
+                  code.co_firstlineno, code.co_lnotab, code.co_freevars, code.co_cellvars)
+
 # Return pretty traceback string of Jinja2 render
 tb_frame_re = re.compile(r"<frame at 0x[a-z0-9]*, file '(.*)', line (\d+), (?:(code top-level template code|code template|code block '.*')|.*)>")
 def jinja2_render_traceback(src_path, including_non_template=False):
@@ -37,4 +37,7 @@ setup(name         = 'j2gpp',
         'toml',
         'configparser'
       ],
+      extras_require = {
+        'completion': ['argcomplete']
+      },
 )